@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+"""
+Runs the receiver, decoder, broadcaster and stereo together in a single
+process, e.g. on a Raspberry Pi.
+
+Components talk over bounded in-memory queues (see memory_amqp.py) rather than
+RabbitMQ. Set `STORE_BACKEND = "embedded"` in settings to do without MongoDB
+too (see embedded_store.py).
+"""
+
+import threading
+import time
+
+import log
+import memory_amqp
+import settings
+from broadcaster import Broadcaster
+from decoder import Decoder
+from stereo import Stereo
+import userstream_receiver
+
+logger = log.get_logger("allinone")
+
+if __name__ == "__main__":
+    # Start logging
+    log.setup()
+
+    # Run the shared IOLoop in the background, the userstream in the foreground
+    ioloop = threading.Thread(target=memory_amqp.ioloop.start, name="nmstereo-ioloop")
+    ioloop.daemon = True
+    ioloop.start()
+
+    # The stereo must be bound to the broadcast exchange before the
+    # broadcaster sends anything, otherwise it's dropped
+    stereo = Stereo(amqp=memory_amqp)
+    while not stereo.in_queue_declared:
+        time.sleep(0.1)
+
+    broadcaster = Broadcaster(amqp=memory_amqp)
+    decoder = Decoder(amqp=memory_amqp)
+
+    logger.info("started", store=getattr(settings, "STORE_BACKEND", "mongodb"))
+    try:
+        userstream_receiver.run(userstream_receiver.StreamListener(amqp=memory_amqp))
+    finally:
+        memory_amqp.ioloop.stop()
+        ioloop.join()
@@ -4,21 +4,29 @@
 Picks up requests from the playlist, and broadcasts to all connected clients.
 """
 
-import codecs
+import collections
 import datetime
 import json
 import pprint
 import sys
-from threading import Timer
+from threading import RLock, Timer
 
 from bson.objectid import ObjectId
 import pika
-from pymongo import Connection
 import twitter
 
+import db
+import limits
+import log
+import queue_index
 import settings
+import spotify
+import stats
+import status
 import utils
 
+logger = log.get_logger("broadcaster")
+
 class Broadcaster(object):
     """
     Receives items, sets their status to 'queued', plays them in order when
@@ -26,11 +34,11 @@ class Broadcaster(object):
     """
     
     timeout = False
-    items = []
+    items = None
     current_item = None
     receive_delivery_confirmations = False
     
-    def __init__(self):
+    def __init__(self, amqp=pika):
         # Twitter client
         self.twitter = twitter.Twitter(api_version='1', 
                                        auth=twitter.oauth.OAuth(getattr(settings, "OAUTH_ACCESS_KEY"), 
@@ -39,15 +47,42 @@ class Broadcaster(object):
                                                                 getattr(settings, "OAUTH_CONSUMER_SECRET")))
         
         # MongoDB
-        self.mongo_connection = Connection()
+        self.mongo_connection = db.connection()
         self.playlist_store = self.mongo_connection[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_PLAYLIST_COLLECTION")]
+        self.stats_store = self.mongo_connection[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_STATS_COLLECTION", "nmstereo_stats")]
+        
+        # The queue and current item are changed from the ioloop (on_item,
+        # on_confirmation) and from Timer threads (next), one at a time
+        self.lock = RLock()
         
-        # Load previously queued items
-        self.items = [item for item in self.playlist_store.find({'status': 'queued'})]
+        # Load previously queued items, indexed by duration for ETAs
+        self.items = queue_index.DurationQueue(self.playlist_store.find({'status': 'queued'}).sort('_id', 1))
         
         # Load 'playing' or 'sent' items -- there should be only ONE!
         self.current_item = self.playlist_store.find_one({'$or': [{'status':'sent'},{'status':'playing'}]})        
         
+        # Load recently played items, most recent first
+        history_size = getattr(settings, "STATUS_HISTORY_SIZE", 20)
+        self.history = collections.deque(self.playlist_store.find({'status': 'played'}).sort('start_date', -1).limit(history_size),
+                                         history_size)
+        
+        # Fires next() at the end of the current item
+        self.timer = None
+        
+        # Requests already told their ETA, one DM per request, however many tracks
+        self.replied = limits.RecentIndex(3600, 1000)
+        
+        # Status API, served from memory
+        self.status = None
+        if getattr(settings, "STATUS_API_PORT", None):
+            self.status = status.StatusServer(getattr(settings, "STATUS_API_HOST", "localhost"),
+                                              getattr(settings, "STATUS_API_PORT"))
+            self.publish_status()
+            self.status.start()
+        
+        # AMQP, pika or an in-memory stand-in (see memory_amqp.py)
+        self.amqp = amqp
+        
         # AMQP, get queue names
         self.amqp_in_queue = getattr(settings, "AMQP_IN_BROADCAST_QUEUE")
         self.amqp_confirm_queue = getattr(settings, "AMQP_CONFIRM_BROADCAST_QUEUE")
@@ -57,8 +92,8 @@ class Broadcaster(object):
         
         # AMQP, async style!
         # Create our connection parameters and connect to RabbitMQ
-        parameters = pika.ConnectionParameters(getattr(settings, "AMQP_HOST"))
-        self.amqp_connection = pika.SelectConnection(parameters, self.on_connected)
+        parameters = self.amqp.ConnectionParameters(getattr(settings, "AMQP_HOST"))
+        self.amqp_connection = self.amqp.SelectConnection(parameters, self.on_connected)
         
         # Add timeout handler (from http://stackoverflow.com/a/8181008)
         if self.timeout:
@@ -83,81 +118,197 @@ class Broadcaster(object):
         Broadcasts the next item to all interested parties.
         """
         
-        # Check that we have something to send
-        if len(self.items) > 0:
+        with self.lock:
+            # Check that we have something to send
+            if len(self.items) > 0:
             
-            # If no items 'sent' or 'playing', send next item in queue
-            sent_items = [item for item in self.playlist_store.find({'status':'sent'})]
-            playing_items = [item for item in self.playlist_store.find({'status':'playing'})]
+                # If no items 'sent' or 'playing', send next item in queue
+                sent_items = [item for item in self.playlist_store.find({'status':'sent'})]
+                playing_items = [item for item in self.playlist_store.find({'status':'playing'})]
             
-            # Look for any expired items in playing
-            expired = False
-            for item in playing_items:
-                end_date = item['start_date'] + datetime.timedelta(seconds=item['track']['track']['length'])
-                expired = expired or end_date < datetime.datetime.now()
+                # Look for any expired items in playing
+                expired = False
+                for item in playing_items:
+                    end_date = item['start_date'] + datetime.timedelta(seconds=item['track']['track']['length'])
+                    expired = expired or end_date < datetime.datetime.now()
             
-            # Assume we send nothing
-            send_item = False
-            # Conditions under which we send...
-            # 1. Nothing sent, and nothing playing
-            send_item = send_item or (len(sent_items) == 0 and len(playing_items) == 0)
-            # 2. Nothing sent, and something expired marked as playing
-            send_item = send_item or (len(sent_items) == 0 and len(playing_items) > 0 and expired)
+                # Assume we send nothing
+                send_item = False
+                # Conditions under which we send...
+                # 1. Nothing sent, and nothing playing
+                send_item = send_item or (len(sent_items) == 0 and len(playing_items) == 0)
+                # 2. Nothing sent, and something expired marked as playing
+                send_item = send_item or (len(sent_items) == 0 and len(playing_items) > 0 and expired)
             
-            if send_item:
+                if send_item:
+                
+                    # Skipping any items that can't be broadcast
+                    while len(self.items) > 0:
                 
-                # Send next item in queue
-                self.current_item = self.items.pop(0)
-                print " [x] Sending %r" % (self.current_item['track']['track']['name'],)
+                        # Check the next item in queue can be broadcast, before taking it off
+                        item = next(iter(self.items))
+                        try:
+                            body = self.message(item)
+                        except (KeyError, TypeError, ValueError):
+                            # Drop it, rather than stopping playback
+                            logger.exception("can't broadcast", id=str(item['_id']))
+                            self.items.remove(item['_id'])
+                            item['status'] = 'failed'
+                            self.playlist_store.update({'_id': item['_id']}, item)
+                            continue
+                    
+                        # Send next item in queue
+                        self.current_item = self.items.popleft()
+                        logger.info("sending", track=self.current_item['track']['track']['name'], id=str(self.current_item['_id']))
                 
-                # Send using the broadcast exchange (Pub/Sub)
-                self.amqp_primary_channel.basic_publish(exchange=self.amqp_broadcast_exchange,
-                                                        routing_key='',
-                                                        body=json.dumps({'_id': str(self.current_item['_id']),
-                                                                         'track': self.current_item['track'],
-                                                                         'from': self.current_item['from']}),
-                                                        properties=pika.BasicProperties(
-                                                          content_type="application/json",
-                                                          delivery_mode=2))
+                        # Send using the broadcast exchange (Pub/Sub)
+                        self.amqp_primary_channel.basic_publish(exchange=self.amqp_broadcast_exchange,
+                                                                routing_key='',
+                                                                body=body,
+                                                                properties=self.amqp.BasicProperties(
+                                                                  content_type="application/json",
+                                                                  delivery_mode=2))
                 
-                # Mark item as sent
-                self.current_item['status'] = 'sent'
-                self.playlist_store.update({'_id': self.current_item['_id']}, self.current_item)
+                        # Mark item as sent
+                        self.current_item['status'] = 'sent'
+                        self.playlist_store.update({'_id': self.current_item['_id']}, self.current_item)
+                        break
             
-            elif len(sent_items) == 0 and len(playing_items) > 0 and not expired:
-                # TODO
-                # If something playing and nothing sent, set up timer
-                # timer = Timer(self.current_item['track']['track']['length'], self.next)
-                # timer.start()
-                pass
-    
-    def next(self):
-        print " [x] Next!"
+                elif len(sent_items) == 0 and len(playing_items) > 0 and not expired:
+                    # TODO
+                    # If something playing and nothing sent, set up timer
+                    # timer = Timer(self.current_item['track']['track']['length'], self.next)
+                    # timer.start()
+                    pass
         
-        # Set current item to played
-        self.current_item['status'] = 'played'
-        self.playlist_store.update({'_id': self.current_item['_id']}, self.current_item)
-        
-        # Play next item
-        self.send()
+            # Called whenever the queue or current item may have changed
+            self.publish_status()
+    
+    def message(self, item):
+        """
+        Returns the JSON broadcast for item. Cache fields are left out, as items
+        queued before they were stripped on decoding may still have them.
+        """
+        return json.dumps({'_id': str(item['_id']),
+                           'track': spotify.playlist_track(item['track']),
+                           'from': item['from']})
+    
+    def remaining(self):
+        """
+        Returns the number of seconds until the current item finishes.
+        """
+        if self.current_item is None:
+            return 0
+        length = self.current_item['track']['track']['length']
+        if 'start_date' in self.current_item and self.current_item['status'] == 'playing':
+            elapsed = datetime.datetime.now() - self.current_item['start_date']
+            return max(0, length - elapsed.total_seconds())
+        return length
+    
+    def eta(self, item):
+        """
+        Returns item's position in the queue, and when it should start playing.
+        """
+        with self.lock:
+            wait = self.remaining() + self.items.wait(item['_id'])
+            return self.items.position(item['_id']), datetime.datetime.now() + datetime.timedelta(seconds=wait)
+    
+    def reply(self, item):
+        """
+        Lets the requester know where their item is in the queue, by DM. Only
+        the first item queued for each request (i.e. each `item_id`) is
+        replied to.
+        """
+        if not getattr(settings, "NMSTEREO_SEND_ETA_DMS", False):
+            return
+        request_id = str(item.get('item_id', item['_id']))
+        if request_id in self.replied:
+            return
+        self.replied.add(request_id)
+        try:
+            track_name = item['track']['track']['name']
+            screen_name = item['from']['screen_name']
+            with self.lock:
+                if item['_id'] in self.items:
+                    position, start = self.eta(item)
+                    msg = '%s is #%d in the queue, playing at about %s' % (track_name, position, start.strftime('%H:%M'))
+                else:
+                    msg = '%s is up now!' % (track_name,)
+            self.twitter.direct_messages.new(user=screen_name, text=msg[:140])
+        except:
+            logger.exception("reply failed", id=str(item['_id']))
+    
+    def publish_status(self):
+        """
+        Publishes the current state to the status API, if running.
+        """
+        if self.status is None:
+            return
+        # Walk the queue once, rather than looking up each item's ETA
+        queue = []
+        with self.lock:
+            start = datetime.datetime.now() + datetime.timedelta(seconds=self.remaining())
+            for item in self.items:
+                queue.append((item, start))
+                start += datetime.timedelta(seconds=item['track']['track']['length'])
+            current_item, history = self.current_item, list(self.history)
+        self.status.publish(current_item, queue, history)
+    
+    def record_play(self, item):
+        # Stats mustn't stop playback
+        try:
+            stats.record_play(self.stats_store, item)
+        except:
+            logger.exception("stats failed", id=str(item['_id']))
+    
+    def next(self, id):
+        """
+        Fires at the end of the item with id, moving on to the next item, unless
+        id has since been replaced by, or re-confirmed as, the current item.
+        """
+        with self.lock:
+            if self.current_item is None or self.current_item['_id'] != id or self.current_item['status'] != 'playing':
+                logger.info("stale timer", id=str(id))
+                return
+            logger.info("next", id=str(id))
+            
+            # Set current item to played
+            self.current_item['status'] = 'played'
+            self.playlist_store.update({'_id': self.current_item['_id']}, self.current_item)
+            self.record_play(self.current_item)
+            self.history.appendleft(self.current_item)
+            
+            # Play next item
+            self.send()
                 
     def now_playing(self, id):
-        # Override current item with this id
-        self.current_item = self.playlist_store.find_one({'_id': ObjectId(id)})
+        with self.lock:
+            # Override current item with this id
+            self.current_item = self.playlist_store.find_one({'_id': ObjectId(id)})
         
-        # Mark existing 'playing' items as 'played'
-        for item in self.playlist_store.find({'status':'playing'}):
-            item['status'] = 'played'
-            self.playlist_store.update({'_id': item['_id']}, item)
+            # Mark existing 'playing' items as 'played'
+            for item in self.playlist_store.find({'status':'playing'}):
+                if item['_id'] == self.current_item['_id']:
+                    # Confirmed twice, still playing
+                    continue
+                item['status'] = 'played'
+                self.playlist_store.update({'_id': item['_id']}, item)
+                self.record_play(item)
+                self.history.appendleft(item)
         
-        # Mark current item as 'playing', set start_time
-        self.current_item['status'] = 'playing'
-        self.current_item['start_date'] = datetime.datetime.now()
-        self.playlist_store.update({'_id': self.current_item['_id']}, self.current_item)
+            # Mark current item as 'playing', set start_time
+            self.current_item['status'] = 'playing'
+            self.current_item['start_date'] = datetime.datetime.now()
+            self.playlist_store.update({'_id': self.current_item['_id']}, self.current_item)
         
-        # Set up timer to fire at the end of the current item
-        timer = Timer(self.current_item['track']['track']['length'], self.next)
-        timer.start()
+            # Set up timer to fire at the end of the current item, replacing
+            # any set for a previous item, or a previous confirmation
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = Timer(self.current_item['track']['track']['length'], self.next, [self.current_item['_id']])
+            self.timer.start()
+        
+        self.publish_status()
         
         # Tweet!
         if getattr(settings, "NMSTEREO_SEND_TWEETS", True):
@@ -172,7 +323,7 @@ class Broadcaster(object):
                                              long="-0.14594435691833496", 
                                              display_coordinates=True)
             except:
-                pass
+                logger.exception("tweet failed")
     
     def on_timeout(self):
         self.amqp_connection.close()
@@ -246,21 +397,25 @@ class Broadcaster(object):
         try:
             # Get the item from the playlist store
             item = self.playlist_store.find_one({'_id': ObjectId(body)})
-            print " [x] Received %r" % (item['track']['track']['name'],)
+            logger.info("received", track=item['track']['track']['name'], id=body)
             
         except:
-            print " [x] Not found: %r" % (body,)
+            logger.warning("not found", id=body)
             
         else:
-            # Add item to our list
-            self.items.append(item)
-            
-            # Mark item as 'queued'
-            item['status'] = 'queued'
-            self.playlist_store.update({'_id': item['_id']}, item)
+            with self.lock:
+                # Add item to our list
+                self.items.append(item)
+                
+                # Mark item as 'queued'
+                item['status'] = 'queued'
+                self.playlist_store.update({'_id': item['_id']}, item)
+                
+                # If no items 'sent' or 'playing', broadcast next item in queue
+                self.send()
             
-            # If no items 'sent' or 'playing', broadcast next item in queue
-            self.send()
+            # Tell the requester when to expect it
+            self.reply(item)
         
         # Acknowledge
         ch.basic_ack(delivery_tag=method.delivery_tag)
@@ -270,7 +425,7 @@ class Broadcaster(object):
         Fires when a message has been received. Clients are responsible for 'firing' this by 
         publishing to the `self.amqp_confirm_queue` queue.
         """
-        print " [x] Received confirmation %r" % (body,)
+        logger.info("received confirmation", id=body)
         self.now_playing(body)
         ch.basic_ack(delivery_tag=method.delivery_tag)
     
@@ -282,14 +437,14 @@ class Broadcaster(object):
     
 
 if __name__ == "__main__":
-    # Write UTF-8 to stdout
-    sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+    # Start logging
+    log.setup()
     
     broadcaster = Broadcaster()
     # pprint.pprint(broadcaster.items)
     
     try:
-        print ' [*] Waiting for messages. To exit press CTRL+C'
+        logger.info("waiting for messages", hint="To exit press CTRL+C")
         broadcaster.start()
     except KeyboardInterrupt:
         broadcaster.close()
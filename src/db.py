@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+"""
+Hands out connections to the document store.
+
+MongoDB by default, or the embedded store (see embedded_store.py) when
+`STORE_BACKEND = "embedded"` in settings.
+"""
+
+from pymongo import Connection
+
+import settings
+
+_embedded_connection = None
+
+def connection():
+    """
+    Returns a connection, indexable as `connection[db_name][collection_name]`.
+
+    The embedded store is shared by everything in the process, so components
+    running together (see allinone.py) see each other's writes.
+    """
+    global _embedded_connection
+    if getattr(settings, "STORE_BACKEND", "mongodb") == "embedded":
+        if _embedded_connection is None:
+            import embedded_store
+            # Every stream event is saved, but only needed until it's decoded
+            capped = getattr(settings, "STORE_CAPPED_COLLECTIONS",
+                             {getattr(settings, "MONGODB_USERSTREAM_COLLECTION"): 10000})
+            _embedded_connection = embedded_store.Connection(getattr(settings, "STORE_PATH", None), capped)
+        return _embedded_connection
+    return Connection()
@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import codecs
 import json
 import pprint
 import re
@@ -9,12 +8,16 @@ import urllib
 
 from bson.objectid import ObjectId
 import pika
-from pymongo import Connection
 
+import db
+import limits
+import log
 import settings
 import spotify
 import utils
 
+logger = log.get_logger("decoder")
+
 class Decoder(object):
     """
     Receives DMs, extracts and decodes Spotify URIs, then passes track + 
@@ -25,21 +28,31 @@ class Decoder(object):
     receive_delivery_confirmations = False
     in_queue_declared = False
     out_queue_declared = False
+    resolved = 0
     
-    def __init__(self):
+    def __init__(self, amqp=pika):
         # MongoDB
-        self.mongo_connection = Connection()
+        self.mongo_connection = db.connection()
         self.userstream_store = self.mongo_connection[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_USERSTREAM_COLLECTION")]
         self.playlist_store = self.mongo_connection[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_PLAYLIST_COLLECTION")]
         
+        # Request limits, per requester and per track
+        self.limiter = limits.SlidingWindowLimiter(getattr(settings, "DECODER_RATE_LIMIT", 0),
+                                                   getattr(settings, "DECODER_RATE_WINDOW", 600))
+        self.recently_queued = limits.RecentIndex(getattr(settings, "DECODER_DUPLICATE_WINDOW", 0),
+                                                  getattr(settings, "DECODER_DUPLICATE_MAX", 1000))
+        
+        # AMQP, pika or an in-memory stand-in (see memory_amqp.py)
+        self.amqp = amqp
+        
         # AMQP, get queue names
         self.amqp_in_queue = getattr(settings, "AMQP_MAIN_QUEUE")
         self.amqp_out_queue = getattr(settings, "AMQP_IN_BROADCAST_QUEUE")
         
         # AMQP, async style!
         # Create our connection parameters and connect to RabbitMQ
-        parameters = pika.ConnectionParameters(getattr(settings, "AMQP_HOST"))
-        self.amqp_connection = pika.SelectConnection(parameters, self.on_connected)
+        parameters = self.amqp.ConnectionParameters(getattr(settings, "AMQP_HOST"))
+        self.amqp_connection = self.amqp.SelectConnection(parameters, self.on_connected)
         
         # Add timeout handler (from http://stackoverflow.com/a/8181008)
         if self.timeout:
@@ -105,31 +118,68 @@ class Decoder(object):
         
         # Lookup data in store, body should actually be an ObjectId        
         item = self.userstream_store.find_one({"_id": ObjectId(body)})
+        if item is None:
+            logger.warning("not found", id=body)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
         
         if utils.item_a_direct_message(item) or utils.item_a_mention(item):
             text, screen_name = (utils.get_text(item), utils.get_screen_name(item))
-            print " [x] Received %r from %r" % (text, screen_name)
+            logger.info("received", text=text, screen_name=screen_name)
             
-            # Any Spotify tracks?
-            tracks = spotify.lookup_tracks(text)
+            # Already at their limit? Don't even look for tracks
+            if self.limiter.remaining(screen_name) <= 0:
+                logger.info("rate limited", screen_name=screen_name)
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
             
-            if len(tracks) > 0:
-                # Save to playlist
-                for track in tracks:
-                    id = self.playlist_store.save({'track':track, 'status':'new', 'source':'twitter', 'from':utils.get_sender(item)})
-                    # Send each track to the broadcaster's 'receive' queue, so it can be broadcast 
-                    # to all connected clients
-                    print " [x] Sending %r to broadcaster" % (track['track']['name'],)
-                    self.amqp_primary_channel.basic_publish(exchange='',
-                                                            routing_key=self.amqp_out_queue,
-                                                            body=str(id),
-                                                            properties=pika.BasicProperties(
-                                                                delivery_mode=2, # make message persistent
-                                                            ))
+            # Any Spotify tracks? Albums and playlists are expanded, and their
+            # tracks looked up, lazily, only those accepted being cached
+            self.resolved = 0
+            listed = {}
+            uris = self.accept(spotify.iter_track_uris(text, listed=listed), screen_name)
+            tracks = spotify.iter_lookup(uris, listed=listed)
+            
+            # Save to playlist
+            for track in tracks:
+                # Only tracks that resolved count against the requester
+                self.limiter.record(screen_name)
+                self.resolved += 1
+                id = self.playlist_store.save({'track':spotify.playlist_track(track), 'status':'new', 'source':'twitter', 'from':utils.get_sender(item), 'item_id':item['_id']})
+                # Send each track to the broadcaster's 'receive' queue, so it can be broadcast 
+                # to all connected clients
+                logger.info("sending to broadcaster", track=track['track']['name'], id=str(id))
+                self.amqp_primary_channel.basic_publish(exchange='',
+                                                        routing_key=self.amqp_out_queue,
+                                                        body=str(id),
+                                                        properties=self.amqp.BasicProperties(
+                                                            delivery_mode=2, # make message persistent
+                                                        ))
+                self.recently_queued.add(track['track']['href'])
             
             # Confirm delivery
             ch.basic_ack(delivery_tag=method.delivery_tag)
     
+    def accept(self, uris, screen_name):
+        """
+        Yields those of uris that aren't recent duplicates, and are within
+        screen_name's rate limit, allowing for those yielded but not yet
+        resolved (see `self.resolved`). Rejects are logged and dropped, and
+        nothing more is taken from uris once the limit is reached.
+        """
+        yielded = 0
+        uris = iter(uris)
+        while self.limiter.remaining(screen_name) > yielded - self.resolved:
+            uri = next(uris, None)
+            if uri is None:
+                return
+            if uri in self.recently_queued:
+                logger.info("duplicate dropped", uri=uri, screen_name=screen_name)
+            else:
+                yielded += 1
+                yield uri
+        logger.info("rate limited", screen_name=screen_name)
+    
     def on_delivered(self, frame):
         """
         Fires when a message has been delivered.
@@ -138,15 +188,15 @@ class Decoder(object):
     
 
 if __name__ == "__main__":
-    # Write UTF-8 to stdout
-    sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+    # Start logging
+    log.setup()
     
     # receiver = DMReceiver()
     # receiver.start_consuming()
     decoder = Decoder()
     
     try:
-        print ' [*] Waiting for messages. To exit press CTRL+C'
+        logger.info("waiting for messages", hint="To exit press CTRL+C")
         decoder.start()
     except KeyboardInterrupt:
         decoder.close()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+"""
+A small, embedded stand-in for the parts of MongoDB used by nmstereo, for
+hosts too small to run mongod (see allinone.py).
+
+Collections are kept in memory, or in `shelve` files under `STORE_PATH` when
+set, and may be capped (see `STORE_CAPPED_COLLECTIONS`). Queries support plain and dotted-key equality, `$or`, `$and`, and the
+`$in`, `$nin`, `$ne`, `$exists`, `$gt`, `$gte`, `$lt` and `$lte` operators.
+Updates support whole document replacement, `$set` and `$inc`.
+"""
+
+import collections
+import copy
+import os
+import shelve
+import threading
+
+from bson.objectid import ObjectId
+
+_MISSING = object()
+
+def _get(doc, key):
+    """
+    Returns the value of a (possibly dotted) key in doc, or `_MISSING`.
+    """
+    for part in key.split("."):
+        if isinstance(doc, dict) and part in doc:
+            doc = doc[part]
+        else:
+            return _MISSING
+    return doc
+
+def _values(doc, key):
+    """
+    Returns the values of a (possibly dotted) key in doc, looking inside
+    lists as MongoDB does, i.e. [_MISSING] if there are none.
+    """
+    docs = [doc]
+    for part in key.split("."):
+        found = []
+        for d in docs:
+            for d in (d if isinstance(d, list) else [d]):
+                if isinstance(d, dict) and part in d:
+                    found.append(d[part])
+        if not found:
+            return [_MISSING]
+        docs = found
+    # A list value matches on any of its elements too
+    return docs + [v for d in docs if isinstance(d, list) for v in d]
+
+def _set(doc, key, value):
+    parts = key.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+_OPERATORS = {
+    "$in": lambda value, arg: value in arg,
+    "$nin": lambda value, arg: value not in arg,
+    "$ne": lambda value, arg: value != arg,
+    "$exists": lambda value, arg: (value is not _MISSING) == bool(arg),
+    "$gt": lambda value, arg: value is not _MISSING and value > arg,
+    "$gte": lambda value, arg: value is not _MISSING and value >= arg,
+    "$lt": lambda value, arg: value is not _MISSING and value < arg,
+    "$lte": lambda value, arg: value is not _MISSING and value <= arg,
+}
+
+def match(doc, spec):
+    """
+    Returns True if doc matches the query spec.
+    """
+    for key, cond in spec.iteritems():
+        if key == "$or":
+            if not any(match(doc, s) for s in cond):
+                return False
+        elif key == "$and":
+            if not all(match(doc, s) for s in cond):
+                return False
+        else:
+            values = _values(doc, key)
+            if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+                for op, arg in cond.iteritems():
+                    # Negations must hold for every value, the rest for any
+                    test = all if op in ("$ne", "$nin") else any
+                    if not test(_OPERATORS[op](value, arg) for value in values):
+                        return False
+            elif cond not in values:
+                return False
+    return True
+
+def _key(id):
+    # shelve keys must be strings, keep ObjectIds and strings apart
+    # (str and unicode are the same to MongoDB)
+    kind = "str" if isinstance(id, basestring) else type(id).__name__
+    return ("%s:%s" % (kind, unicode(id))).encode("utf8")
+
+class Cursor(object):
+    """
+    Iterable result of `Collection.find`.
+    """
+
+    def __init__(self, docs):
+        self.docs = docs
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        self.docs.sort(key=lambda doc: _get(doc, key), reverse=direction < 0)
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def batch_size(self, n):
+        # Everything is already in memory
+        return self
+
+    def count(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        end = self._skip + self._limit if self._limit else None
+        return iter(self.docs[self._skip:end])
+
+class Collection(object):
+    """
+    Documents, keyed by `_id`, and indexed by `status`.
+
+    Queries on `_id` (plain or `$in`) or `status` (plain), or `$or`s of those,
+    only look at the documents they could match; anything else is a scan. If
+    max_docs is set, the collection is capped, oldest documents dropped first.
+    """
+
+    indexed = "status"
+
+    def __init__(self, docs, max_docs=None):
+        self.docs = docs
+        self.max_docs = max_docs
+        self.lock = threading.RLock()
+
+        # Keys, oldest first (ObjectIds sort by creation time)
+        self.order = collections.OrderedDict((key, None) for key in sorted(docs.keys()))
+
+        # Indexed value -> keys, and key -> indexed value
+        self.index = {}
+        self.index_values = {}
+        for key in self.order:
+            self._index(key, docs[key])
+
+    def _index(self, key, doc):
+        self._unindex(key)
+        value = doc.get(self.indexed, _MISSING)
+        if value is not _MISSING and not isinstance(value, (dict, list)):
+            self.index.setdefault(value, set()).add(key)
+            self.index_values[key] = value
+
+    def _unindex(self, key):
+        value = self.index_values.pop(key, _MISSING)
+        if value is not _MISSING:
+            self.index[value].discard(key)
+
+    def _candidates(self, spec):
+        """
+        Returns the keys of all documents that could match spec, or None if
+        that would take a scan.
+        """
+        if "_id" in spec:
+            cond = spec["_id"]
+            if not isinstance(cond, dict):
+                return set([_key(cond)])
+            if cond.keys() == ["$in"]:
+                return set(_key(id) for id in cond["$in"])
+        if self.indexed in spec and not isinstance(spec[self.indexed], dict):
+            return set(self.index.get(spec[self.indexed], ()))
+        if "$or" in spec:
+            keys = set()
+            for clause in spec["$or"]:
+                clause_keys = self._candidates(clause)
+                if clause_keys is None:
+                    return None
+                keys |= clause_keys
+            return keys
+        return None
+
+    def _matches(self, spec):
+        """
+        Yields (key, doc) for documents matching spec, oldest first.
+        """
+        keys = self._candidates(spec)
+        if keys is None:
+            keys = self.order
+        else:
+            keys = sorted(key for key in keys if key in self.order)
+        for key in keys:
+            doc = self.docs[key]
+            if match(doc, spec):
+                yield key, doc
+
+    def ensure_index(self, key_or_list):
+        # Only status is indexed, anything else is a scan
+        pass
+
+    def _sync(self):
+        if hasattr(self.docs, "sync"):
+            self.docs.sync()
+
+    def find_one(self, spec=None):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {"_id": spec}
+        with self.lock:
+            for key, doc in self._matches(spec or {}):
+                return copy.deepcopy(doc)
+        return None
+
+    def find(self, spec=None, fields=None, timeout=True):
+        with self.lock:
+            docs = [copy.deepcopy(doc) for key, doc in self._matches(spec or {})]
+        if fields:
+            docs = [dict((k, doc[k]) for k in doc if k in fields or k == "_id") for doc in docs]
+        return Cursor(docs)
+
+    def save(self, doc):
+        if "_id" not in doc:
+            doc["_id"] = ObjectId()
+        key = _key(doc["_id"])
+        with self.lock:
+            self.docs[key] = copy.deepcopy(doc)
+            self._index(key, doc)
+            if key not in self.order:
+                self.order[key] = None
+                if self.max_docs and len(self.order) > self.max_docs:
+                    self._delete(next(iter(self.order)))
+            self._sync()
+        return doc["_id"]
+
+    def insert(self, doc_or_docs):
+        if isinstance(doc_or_docs, list):
+            return [self.save(doc) for doc in doc_or_docs]
+        return self.save(doc_or_docs)
+
+    def update(self, spec, document, upsert=False, multi=False):
+        with self.lock:
+            docs = [doc for doc in self.find(spec)]
+            if not multi:
+                docs = docs[:1]
+            if not docs and upsert:
+                doc = dict((k, v) for k, v in spec.iteritems() if not k.startswith("$") and not isinstance(v, dict))
+                docs = [doc]
+
+            for doc in docs:
+                if any(k.startswith("$") for k in document):
+                    for key, value in document.get("$set", {}).iteritems():
+                        _set(doc, key, value)
+                    for key, value in document.get("$inc", {}).iteritems():
+                        current = _get(doc, key)
+                        _set(doc, key, (0 if current is _MISSING else current) + value)
+                else:
+                    id = doc.get("_id")
+                    doc = dict(document)
+                    if id is not None:
+                        doc["_id"] = id
+                self.save(doc)
+
+    def _delete(self, key):
+        del self.docs[key]
+        del self.order[key]
+        self._unindex(key)
+
+    def remove(self, spec=None):
+        with self.lock:
+            for key in [key for key, doc in self._matches(spec or {})]:
+                self._delete(key)
+            self._sync()
+
+class Database(object):
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def __getitem__(self, name):
+        return self.connection.collection(self.name, name)
+
+class Connection(object):
+    """
+    Mimics `pymongo.Connection`, i.e. `Connection()[db_name][collection_name]`.
+
+    If path is None, everything is kept in memory. capped maps collection
+    names to the most documents they should keep.
+    """
+
+    def __init__(self, path=None, capped=None):
+        self.path = path
+        self.capped = capped or {}
+        self.collections = {}
+        self.lock = threading.Lock()
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __getitem__(self, name):
+        return Database(self, name)
+
+    def collection(self, db_name, name):
+        with self.lock:
+            key = (db_name, name)
+            if key not in self.collections:
+                if self.path:
+                    docs = shelve.open(os.path.join(self.path, "%s.%s" % (db_name, name)), protocol=2)
+                else:
+                    docs = {}
+                self.collections[key] = Collection(docs, self.capped.get(name))
+            return self.collections[key]
+
+    def close(self):
+        for collection in self.collections.values():
+            if hasattr(collection.docs, "close"):
+                collection.docs.close()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+In-memory request limits, for rejecting floods of requests cheaply before
+they reach Spotify, MongoDB or the broadcaster.
+"""
+
+import collections
+import time
+
+class SlidingWindowLimiter(object):
+    """
+    Allows each key (e.g. a screen_name) at most `limit` events in any
+    `window` seconds. A limit of 0 or None allows everything.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.events = {}
+        self.swept = time.time()
+
+    def _prune(self, key, now):
+        # Forget events that have slid out of the window, and keys with none
+        events = self.events[key]
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        if not events:
+            del self.events[key]
+            return 0
+        return len(events)
+
+    def _sweep(self, now):
+        # Once a window, so keys that are never checked again are dropped too
+        if now - self.swept >= self.window:
+            for key in self.events.keys():
+                self._prune(key, now)
+            self.swept = now
+
+    def remaining(self, key, now=None):
+        """
+        Returns how many more events key may have right now.
+        """
+        if not self.limit:
+            return float("inf")
+        now = time.time() if now is None else now
+        self._sweep(now)
+        if key not in self.events:
+            return self.limit
+        return self.limit - self._prune(key, now)
+
+    def record(self, key, now=None):
+        """
+        Records an event for key.
+        """
+        if not self.limit:
+            return
+        now = time.time() if now is None else now
+        self.events.setdefault(key, collections.deque()).append(now)
+
+class RecentIndex(object):
+    """
+    Remembers keys (e.g. track URIs) for `ttl` seconds, holding at most
+    `maxsize` of them, oldest dropped first.
+    """
+
+    def __init__(self, ttl, maxsize=1000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.keys = collections.OrderedDict()
+
+    def _expire(self, now):
+        while self.keys:
+            key, added = next(self.keys.iteritems())
+            if added > now - self.ttl and len(self.keys) <= self.maxsize:
+                break
+            del self.keys[key]
+
+    def __contains__(self, key):
+        if not self.ttl:
+            return False
+        self._expire(time.time())
+        return key in self.keys
+
+    def add(self, key, now=None):
+        if not self.ttl:
+            return
+        now = time.time() if now is None else now
+        # Re-adding moves key to the back, i.e. youngest
+        self.keys.pop(key, None)
+        self.keys[key] = now
+        self._expire(now)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""
+Structured, asynchronous logging for the nmstereo components.
+
+Records are pushed onto a bounded in-memory queue by the component doing the
+work, and formatted/written to stdout by a background thread, so the hot paths
+(e.g. `StreamListener.on_data`) never pay for formatting or I/O.
+"""
+
+import atexit
+import codecs
+import logging
+import Queue
+import random
+import sys
+import threading
+
+import settings
+
+# Root logger name, each component logs to a child of this, e.g. 'nmstereo.decoder'
+ROOT_LOGGER_NAME = "nmstereo"
+
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+_listener = None
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    Formats a record, appending any structured key/value pairs attached to
+    it as `key=value` (or `key="some value"`) to the message.
+    """
+
+    def format_value(self, value):
+        if isinstance(value, str):
+            value = value.decode('utf8', 'replace')
+        if isinstance(value, unicode):
+            return u'"%s"' % value.replace(u'"', u'\\"')
+        return unicode(value)
+
+    def format(self, record):
+        record.message = record.getMessage()
+        kv = getattr(record, "kv", None)
+        if kv:
+            record.message = u"%s %s" % (record.message,
+                                         u" ".join(u"%s=%s" % (k, self.format_value(kv[k])) for k in sorted(kv)))
+        record.asctime = self.formatTime(record, self.datefmt)
+        s = self._fmt % record.__dict__
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            s = u"%s\n%s" % (s, record.exc_text.decode('utf8', 'replace'))
+        return s
+
+class QueueHandler(logging.Handler):
+    """
+    Pushes records onto a queue, for a `QueueListener` to write out.
+
+    Never blocks: if the queue is full, the record is dropped.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except:
+            self.handleError(record)
+
+class QueueListener(object):
+    """
+    Pulls records off a queue on a background thread, and hands them to
+    `handler`.
+    """
+
+    _sentinel = None
+
+    def __init__(self, queue, handler):
+        self.queue = queue
+        self.handler = handler
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._monitor, name="nmstereo-log")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # Write out anything still queued, then stop
+        if self.thread is not None:
+            self.queue.put(self._sentinel)
+            self.thread.join()
+            self.thread = None
+        self.handler.flush()
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            if record.levelno >= self.handler.level:
+                self.handler.handle(record)
+
+class StructuredLogger(object):
+    """
+    Thin wrapper around a `logging.Logger`, taking an event name plus
+    key/value pairs, i.e.:
+
+        logger.info("received", screen_name="nmstereo", text="Hello")
+
+    Level checks are done up front, so disabled levels cost a single
+    comparison.
+    """
+
+    def __init__(self, logger, sample_rate=0.0):
+        self.logger = logger
+        self.sample_rate = sample_rate
+
+    def log(self, level, event, **kv):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, extra={"kv": kv})
+
+    def debug(self, event, **kv):
+        self.log(logging.DEBUG, event, **kv)
+
+    def info(self, event, **kv):
+        self.log(logging.INFO, event, **kv)
+
+    def warning(self, event, **kv):
+        self.log(logging.WARNING, event, **kv)
+
+    def error(self, event, **kv):
+        self.log(logging.ERROR, event, **kv)
+
+    def exception(self, event, **kv):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(event, exc_info=True, extra={"kv": kv})
+
+    def payload(self, event, payload, **kv):
+        """
+        Logs a (potentially large) raw payload at DEBUG level, but only for a
+        sample of calls, as set by `LOG_PAYLOAD_SAMPLE_RATE`.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG) and random.random() < self.sample_rate:
+            kv["payload"] = payload
+            self.logger.debug(event, extra={"kv": kv})
+
+def _level(name):
+    """
+    Returns a numeric logging level from a name such as 'INFO', or a number.
+    """
+    if isinstance(name, basestring):
+        return getattr(logging, name.upper())
+    return name
+
+def setup():
+    """
+    Installs the queue-based handler on the root nmstereo logger, and starts
+    the background writer. Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    # Write UTF-8 to stdout, from the writer thread only
+    stream_handler = logging.StreamHandler(codecs.getwriter('utf8')(sys.stdout))
+    stream_handler.setFormatter(KeyValueFormatter(LOG_FORMAT))
+
+    queue = Queue.Queue(getattr(settings, "LOG_QUEUE_SIZE", 10000))
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(_level(getattr(settings, "LOG_LEVEL", "INFO")))
+    root.addHandler(QueueHandler(queue))
+    root.propagate = False
+
+    _listener = QueueListener(queue, stream_handler)
+    _listener.start()
+    atexit.register(shutdown)
+
+def shutdown():
+    """
+    Flushes any queued records and stops the background writer.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def get_logger(component):
+    """
+    Returns a `StructuredLogger` for component, e.g. 'decoder', with its
+    verbosity taken from `LOG_LEVELS` in settings (falling back to
+    `LOG_LEVEL`).
+    """
+    logger = logging.getLogger("%s.%s" % (ROOT_LOGGER_NAME, component))
+    level = getattr(settings, "LOG_LEVELS", {}).get(component)
+    if level is not None:
+        logger.setLevel(_level(level))
+    return StructuredLogger(logger, getattr(settings, "LOG_PAYLOAD_SAMPLE_RATE", 0.0))
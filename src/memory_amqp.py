@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+"""
+In-memory stand-in for the parts of pika used by the nmstereo components, so
+they can all run in a single process (see allinone.py).
+
+Queues are bounded, and consumers are all called from one shared IOLoop, just
+as they would be by pika's `SelectConnection`. Pass this module wherever a
+component takes `amqp=pika`.
+"""
+
+import heapq
+import itertools
+import Queue
+import threading
+import time
+
+import log
+import settings
+
+logger = log.get_logger("memory_amqp")
+
+class QueueFull(Exception):
+    """
+    Raised when publishing to a queue that is full, and cannot be drained
+    (i.e. when publishing from the IOLoop itself, or after `AMQP_MEMORY_PUBLISH_TIMEOUT`).
+    """
+    pass
+
+class ConnectionParameters(object):
+    def __init__(self, host=None, **kwargs):
+        self.host = host
+
+class BasicProperties(object):
+    def __init__(self, content_type=None, delivery_mode=None, **kwargs):
+        self.content_type = content_type
+        self.delivery_mode = delivery_mode
+
+class Frame(object):
+    """
+    Stands in for the method frames pika hands to callbacks, e.g.
+    `frame.method.queue` or `method.delivery_tag`.
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class IOLoop(object):
+    """
+    Runs callbacks and timeouts, in order, on whichever thread calls `start`.
+    """
+
+    # How often to wake up when idle, so KeyboardInterrupt is noticed
+    poll_interval = 1.0
+
+    def __init__(self):
+        self.events = Queue.Queue()
+        self.timeouts = []
+        self.timeout_ids = itertools.count()
+        self.running = False
+        self.thread = None
+
+    def add_callback(self, callback, *args):
+        self.events.put((callback, args))
+
+    def add_timeout(self, seconds, callback):
+        heapq.heappush(self.timeouts, (time.time() + seconds, next(self.timeout_ids), callback))
+        # Wake up, so the new deadline is taken into account
+        self.events.put(None)
+
+    def start(self):
+        self.thread = threading.current_thread()
+        self.running = True
+        while self.running:
+            wait = self.poll_interval
+            if self.timeouts:
+                wait = min(wait, max(0, self.timeouts[0][0] - time.time()))
+
+            try:
+                event = self.events.get(timeout=wait)
+            except Queue.Empty:
+                event = None
+
+            # Fire any expired timeouts
+            while self.timeouts and self.timeouts[0][0] <= time.time():
+                self._run(heapq.heappop(self.timeouts)[2])
+
+            if event is not None:
+                callback, args = event
+                self._run(callback, *args)
+        self.thread = None
+
+    def _run(self, callback, *args):
+        # One failing callback mustn't stop every component on the loop
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception("callback failed", callback=getattr(callback, "__name__", repr(callback)))
+
+    def stop(self):
+        self.running = False
+        self.events.put(None)
+
+class Broker(object):
+    """
+    Holds the bounded queues, fanout exchanges and consumers shared by every
+    connection in the process.
+    """
+
+    def __init__(self, ioloop, maxsize=0, publish_timeout=None):
+        self.ioloop = ioloop
+        self.maxsize = maxsize
+        self.publish_timeout = publish_timeout
+        self.queues = {}
+        self.exchanges = {}
+        self.consumers = {}
+        self.lock = threading.Lock()
+        self.queue_names = itertools.count(1)
+        self.delivery_tags = itertools.count(1)
+
+    def queue_declare(self, name=None):
+        with self.lock:
+            if not name:
+                name = "amq.gen-%d" % (next(self.queue_names),)
+            if name not in self.queues:
+                self.queues[name] = Queue.Queue(self.maxsize)
+        return name
+
+    def exchange_declare(self, name):
+        with self.lock:
+            self.exchanges.setdefault(name, [])
+
+    def queue_bind(self, exchange, name):
+        with self.lock:
+            bound = self.exchanges.setdefault(exchange, [])
+            if name not in bound:
+                bound.append(name)
+
+    def consume(self, name, channel, callback):
+        self.consumers[name] = (channel, callback)
+        # Deliver anything published before we had a consumer
+        for i in range(self.queues[name].qsize()):
+            self.ioloop.add_callback(self.deliver, name)
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        if exchange:
+            # All exchanges are fanout, like the only one we use
+            names = list(self.exchanges.get(exchange, ()))
+        else:
+            names = [routing_key]
+
+        # Publishing from the IOLoop to a full queue would wait forever
+        block = threading.current_thread() is not self.ioloop.thread
+
+        for name in names:
+            queue = self.queues.get(name)
+            if queue is None:
+                # Unroutable, dropped, as with AMQP
+                continue
+            try:
+                queue.put((body, properties), block, self.publish_timeout)
+            except Queue.Full:
+                raise QueueFull(name)
+            self.ioloop.add_callback(self.deliver, name)
+
+    def deliver(self, name):
+        consumer = self.consumers.get(name)
+        if consumer is None:
+            # Left queued until someone consumes
+            return
+        try:
+            body, properties = self.queues[name].get_nowait()
+        except Queue.Empty:
+            return
+        channel, callback = consumer
+        callback(channel, Frame(delivery_tag=next(self.delivery_tags), routing_key=name), properties, body)
+
+class Channel(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+
+    def _callback(self, callback, frame):
+        if callback is not None:
+            self.connection.ioloop.add_callback(callback, frame)
+        return frame
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        pass
+
+    def queue_declare(self, queue=None, durable=False, exclusive=False, auto_delete=False, callback=None):
+        name = self.broker.queue_declare(queue)
+        return self._callback(callback, Frame(method=Frame(queue=name)))
+
+    def exchange_declare(self, exchange=None, type='direct', callback=None):
+        self.broker.exchange_declare(exchange)
+        return self._callback(callback, Frame(method=Frame(exchange=exchange)))
+
+    def queue_bind(self, exchange=None, queue=None, routing_key=None, callback=None):
+        self.broker.queue_bind(exchange, queue)
+        return self._callback(callback, Frame(method=Frame(queue=queue)))
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False):
+        self.broker.consume(queue, self, consumer_callback)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker.publish(exchange, routing_key, body, properties)
+
+    def basic_ack(self, delivery_tag=None):
+        # Messages leave their queue on delivery, nothing to do
+        pass
+
+class SelectConnection(object):
+    """
+    Async connection, all callbacks run on the shared IOLoop.
+    """
+
+    def __init__(self, parameters=None, on_open_callback=None):
+        self.ioloop = ioloop
+        self.broker = broker
+        self.on_close_callbacks = []
+        if on_open_callback is not None:
+            self.ioloop.add_callback(on_open_callback, self)
+
+    def channel(self, on_open_callback):
+        self.ioloop.add_callback(on_open_callback, Channel(self))
+
+    def add_timeout(self, seconds, callback):
+        self.ioloop.add_timeout(seconds, callback)
+
+    def add_on_close_callback(self, callback):
+        self.on_close_callbacks.append(callback)
+
+    def close(self):
+        self.ioloop.add_callback(self._on_closed)
+
+    def _on_closed(self):
+        for callback in self.on_close_callbacks:
+            callback(None)
+
+class BlockingConnection(object):
+    """
+    Sync connection, for publishers running on their own thread.
+    """
+
+    def __init__(self, parameters=None):
+        self.ioloop = ioloop
+        self.broker = broker
+
+    def channel(self):
+        return Channel(self)
+
+    def close(self):
+        pass
+
+# One IOLoop and broker per process
+ioloop = IOLoop()
+broker = Broker(ioloop,
+                maxsize=getattr(settings, "AMQP_MEMORY_QUEUE_SIZE", 1000),
+                publish_timeout=getattr(settings, "AMQP_MEMORY_PUBLISH_TIMEOUT", None))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+A play queue that knows how long until each item plays, without walking the
+queue.
+"""
+
+class FenwickTree(object):
+    """
+    Prefix sums over a fixed number of slots, with O(log n) updates and
+    queries.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    def add(self, i, delta):
+        """
+        Adds delta to slot i (0-based).
+        """
+        i += 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def sum(self, i):
+        """
+        Returns the sum of slots 0 to i-1.
+        """
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+class DurationQueue(object):
+    """
+    A FIFO queue of playlist items, indexed by duration.
+
+    Each item gets the next slot in a pair of Fenwick trees, one over lengths
+    and one over counts, so that an item's position, and the total length of
+    everything ahead of it, are O(log n). Removed items have their slots
+    zeroed. Slots are reallocated (O(n), amortised away) when they run out.
+    """
+
+    def __init__(self, items=(), length=None):
+        self.length = length or (lambda item: item['track']['track']['length'])
+        self._rebuild(list(items))
+
+    def _rebuild(self, items, capacity=None):
+        self.capacity = max(capacity or 0, 2 * len(items), 16)
+        self.lengths = FenwickTree(self.capacity)
+        self.counts = FenwickTree(self.capacity)
+        self.items = {}
+        self.slots = {}
+        self.head = 0
+        self.tail = 0
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        for slot in range(self.head, self.tail):
+            if slot in self.items:
+                yield self.items[slot]
+
+    def append(self, item):
+        """
+        Adds item to the back of the queue, unless it's already queued (e.g.
+        when redelivered), in which case it keeps its place.
+        """
+        if str(item['_id']) in self.slots:
+            return
+        if self.tail == self.capacity:
+            # Out of slots, compact, and grow if more than half full
+            self._rebuild(list(self), 2 * len(self))
+        slot = self.tail
+        self.tail += 1
+        self.items[slot] = item
+        self.slots[str(item['_id'])] = slot
+        self.lengths.add(slot, self.length(item))
+        self.counts.add(slot, 1)
+
+    def popleft(self):
+        while self.head < self.tail and self.head not in self.items:
+            self.head += 1
+        if self.head == self.tail:
+            raise IndexError("pop from an empty queue")
+        item = self.items[self.head]
+        self.remove(item['_id'])
+        return item
+
+    def remove(self, id):
+        """
+        Removes the item with id from the queue, returning it.
+        """
+        slot = self.slots.pop(str(id))
+        item = self.items.pop(slot)
+        self.lengths.add(slot, -self.length(item))
+        self.counts.add(slot, -1)
+        return item
+
+    def __contains__(self, id):
+        return str(id) in self.slots
+
+    def position(self, id):
+        """
+        Returns the 1-based position of the item with id in the queue.
+        """
+        return self.counts.sum(self.slots[str(id)] + 1)
+
+    def wait(self, id):
+        """
+        Returns the total length, in seconds, of the items ahead of the item
+        with id.
+        """
+        return self.lengths.sum(self.slots[str(id)])
+
+    def total(self):
+        """
+        Returns the total length, in seconds, of everything queued.
+        """
+        return self.lengths.sum(self.tail)
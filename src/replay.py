@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+"""
+Replays stored userstream items through the decoding rules, e.g. after
+changing them or recovering from an outage.
+
+Streams `MONGODB_USERSTREAM_COLLECTION` in `_id` order, optionally filtered by
+date range and kind, resolves tracks with batched Spotify lookups across a
+pool of processes, and writes any playlist entries not already there. Progress
+is checkpointed to a file, so an interrupted replay can be resumed.
+
+An entry is already there if one has the same `item_id` and track. Entries
+decoded before `item_id` was saved are matched instead by sender and track,
+decoded within `--legacy-window` seconds of the item arriving.
+
+Needs MongoDB, the embedded store can't be shared with the lookup processes.
+
+E.g.:
+
+    $ replay.py --since 2012-06-01 --until 2012-06-08 --kind dm --checkpoint replay.json
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import time
+
+from bson.objectid import ObjectId
+import pika
+
+import db
+import log
+import settings
+import spotify
+import utils
+
+logger = log.get_logger("replay")
+
+KINDS = ("all", "dm", "mention")
+
+def parse_date(s):
+    return datetime.datetime.strptime(s, "%Y-%m-%d")
+
+def build_query(since=None, until=None, kind="all", after=None):
+    """
+    Returns the userstream query for the given date range and kind, starting
+    after the ObjectId `after` when resuming.
+    """
+    # ObjectIds start with their creation time, so a date range is an _id range
+    id_range = {}
+    if since is not None:
+        id_range["$gte"] = ObjectId.from_datetime(since)
+    if until is not None:
+        id_range["$lt"] = ObjectId.from_datetime(until)
+    if after is not None:
+        id_range["$gt"] = after
+
+    query = {}
+    if id_range:
+        query["_id"] = id_range
+    if kind == "dm":
+        query["direct_message"] = {"$exists": True}
+    elif kind == "mention":
+        query["entities.user_mentions.screen_name"] = getattr(settings, "NMSTEREO_SCREEN_NAME", "nmstereo")
+    return query
+
+def classify(item, kind="all"):
+    """
+    Returns True if item is of the requested kind, using the same rules as the
+    receiver and decoder.
+    """
+    a_direct_message = utils.item_a_direct_message(item)
+    a_mention = not a_direct_message and utils.item_a_mention(item)
+    if kind == "dm":
+        return a_direct_message
+    if kind == "mention":
+        return a_mention
+    return a_direct_message or a_mention
+
+def load_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+def save_checkpoint(path, checkpoint):
+    if path:
+        # Write then rename, so an interruption never leaves a partial file
+        with open(path + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.rename(path + ".tmp", path)
+
+def init_worker():
+    # pymongo connections mustn't be shared over fork, so each worker makes
+    # its own (the embedded store is one per process, so is refused below)
+    spotify.store = db.connection()[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_SPOTIFY_META_COLLECTION")]
+
+def lookup_batch(args):
+    """
+    Resolves a batch of track URIs, in a worker process, caching any listed
+    (see `spotify.iter_track_uris`) from their listings.
+    """
+    uris, listed = args
+    return zip(uris, spotify.lookup_many(uris, listed))
+
+def chunks(l, n):
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+class Replay(object):
+    """
+    Reads requests from the userstream in windows of `window` requests,
+    resolves each window's tracks in parallel, then writes its playlist
+    entries. Checkpoints after each window, and at least every
+    `checkpoint_every` items scanned.
+    """
+
+    def __init__(self, pool, batch_size=50, window=500, checkpoint_every=10000, enqueue=False, checkpoint_path=None,
+                 legacy_window=3600):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.window = window
+        self.checkpoint_every = checkpoint_every
+        self.legacy_window = datetime.timedelta(seconds=legacy_window)
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = load_checkpoint(checkpoint_path)
+        self.counts = self.checkpoint.get("counts", {"scanned": 0, "requests": 0, "written": 0, "skipped": 0})
+        
+        # What album and playlist listings say about the current window's tracks
+        self.listed = {}
+
+        # MongoDB
+        self.mongo_connection = db.connection()
+        self.userstream_store = self.mongo_connection[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_USERSTREAM_COLLECTION")]
+        self.playlist_store = self.mongo_connection[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_PLAYLIST_COLLECTION")]
+        
+        # For the check that each entry is only written once
+        self.playlist_store.ensure_index([('item_id', 1), ('track.track.href', 1)])
+
+        # AMQP, only needed to send new entries on to the broadcaster
+        self.amqp_channel = None
+        if enqueue:
+            self.amqp_out_queue = getattr(settings, "AMQP_IN_BROADCAST_QUEUE")
+            self.amqp_connection = pika.BlockingConnection(
+                pika.ConnectionParameters(host=getattr(settings, "AMQP_HOST")))
+            self.amqp_channel = self.amqp_connection.channel()
+            self.amqp_channel.queue_declare(queue=self.amqp_out_queue, durable=True)
+
+    def run(self, since=None, until=None, kind="all"):
+        after = self.checkpoint.get("last_id")
+        if after is not None:
+            logger.info("resuming", after=after, **self.counts)
+            after = ObjectId(after)
+
+        cursor = self.userstream_store.find(build_query(since, until, kind, after), timeout=False)
+        cursor = cursor.sort("_id", 1).batch_size(self.window)
+
+        started = time.time()
+        requests = []
+        last_id = None
+        unchecked = 0
+        for item in cursor:
+            self.counts["scanned"] += 1
+            unchecked += 1
+            last_id = item["_id"]
+            if classify(item, kind):
+                uris = list(spotify.iter_track_uris(utils.get_text(item) or "", listed=self.listed))
+                if uris:
+                    requests.append((item, uris))
+
+            if len(requests) >= self.window or unchecked >= self.checkpoint_every:
+                self.write(requests, last_id)
+                requests = []
+                unchecked = 0
+                logger.info("progress", rate="%.1f/s" % (self.counts["scanned"] / (time.time() - started),),
+                            last_id=str(last_id), **self.counts)
+
+        if last_id is not None:
+            self.write(requests, last_id)
+        logger.info("done", elapsed="%.1fs" % (time.time() - started,), **self.counts)
+
+    def resolve(self, requests):
+        """
+        Returns a dict of track URI to lookup result, for all requests.
+        """
+        uris = list(set(uri for item, item_uris in requests for uri in item_uris))
+        batches = [(batch, dict((uri, self.listed[uri]) for uri in batch if uri in self.listed))
+                   for batch in chunks(uris, self.batch_size)]
+        self.listed = {}
+        tracks = {}
+        for batch in self.pool.map(lookup_batch, batches):
+            tracks.update(batch)
+        return tracks
+
+    def written(self, item, href):
+        """
+        Returns True if there's already a playlist entry for item and track.
+        """
+        if self.playlist_store.find_one({'item_id': item['_id'], 'track.track.href': href}):
+            return True
+        
+        # Entries from before item_id was saved, from the same sender, for the
+        # same track, decoded soon after item arrived
+        received = item['_id'].generation_time
+        return self.playlist_store.find_one({'_id': {'$gte': ObjectId.from_datetime(received),
+                                                     '$lt': ObjectId.from_datetime(received + self.legacy_window)},
+                                             'item_id': {'$exists': False},
+                                             'from.id': utils.get_sender(item)['id'],
+                                             'track.track.href': href}) is not None
+
+    def write(self, requests, last_id):
+        """
+        Writes playlist entries for requests, skipping any already written, then
+        checkpoints past last_id.
+        """
+        tracks = self.resolve(requests)
+        for item, uris in requests:
+            self.counts["requests"] += 1
+            for uri in uris:
+                track = tracks.get(uri)
+                if track is None:
+                    continue
+
+                # Idempotent, one entry per item and track
+                if self.written(item, track['track']['href']):
+                    self.counts["skipped"] += 1
+                    continue
+
+                entry = {'track':spotify.playlist_track(track), 'status':'new', 'source':'twitter', 'from':utils.get_sender(item), 'item_id':item['_id']}
+                if self.amqp_channel is None:
+                    # Not playing these, just recording them
+                    entry['status'] = 'replayed'
+                id = self.playlist_store.save(entry)
+                self.counts["written"] += 1
+
+                if self.amqp_channel is not None:
+                    self.amqp_channel.basic_publish(exchange='',
+                                                    routing_key=self.amqp_out_queue,
+                                                    body=str(id),
+                                                    properties=pika.BasicProperties(
+                                                        delivery_mode=2, # make message persistent
+                                                    ))
+
+        self.checkpoint = {"last_id": str(last_id), "counts": self.counts}
+        save_checkpoint(self.checkpoint_path, self.checkpoint)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay stored userstream items into the playlist.")
+    parser.add_argument("--since", type=parse_date, help="first day to replay, YYYY-MM-DD")
+    parser.add_argument("--until", type=parse_date, help="day to stop before, YYYY-MM-DD")
+    parser.add_argument("--kind", choices=KINDS, default="all", help="which items to replay")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="Spotify lookup processes")
+    parser.add_argument("--batch-size", type=int, default=50, help="tracks per lookup batch")
+    parser.add_argument("--window", type=int, default=500, help="requests resolved between checkpoints")
+    parser.add_argument("--checkpoint-every", type=int, default=10000, help="items scanned between checkpoints, at most")
+    parser.add_argument("--checkpoint", help="file to checkpoint progress to, and resume from")
+    parser.add_argument("--enqueue", action="store_true", help="send new entries to the broadcaster to be played")
+    parser.add_argument("--legacy-window", type=int, default=3600,
+                        help="seconds after an item arrived to look for entries decoded without an item_id")
+    args = parser.parse_args()
+
+    if getattr(settings, "STORE_BACKEND", "mongodb") == "embedded":
+        parser.error("needs MongoDB, the embedded store can't be shared with the lookup processes")
+
+    # Start logging
+    log.setup()
+
+    pool = multiprocessing.Pool(args.processes, init_worker)
+    try:
+        replay = Replay(pool, batch_size=args.batch_size, window=args.window,
+                        checkpoint_every=args.checkpoint_every, enqueue=args.enqueue, checkpoint_path=args.checkpoint,
+                        legacy_window=args.legacy_window)
+        replay.run(args.since, args.until, args.kind)
+    finally:
+        pool.terminate()
@@ -3,6 +3,13 @@ MONGODB_DB_NAME = "nmstereo"
 MONGODB_USERSTREAM_COLLECTION = "nmstereo_userstream"
 MONGODB_PLAYLIST_COLLECTION = "nmstereo_playlist"
 MONGODB_SPOTIFY_META_COLLECTION = "nmstereo_spotify_meta"
+MONGODB_STATS_COLLECTION = "nmstereo_stats"
+# "mongodb", or "embedded" to do without MongoDB (e.g. with allinone.py)
+STORE_BACKEND = "mongodb"
+# Where the embedded store keeps its files, None to keep everything in memory
+STORE_PATH = None
+# Most documents the embedded store keeps per collection, oldest dropped first
+STORE_CAPPED_COLLECTIONS = {MONGODB_USERSTREAM_COLLECTION: 10000}
 
 # AMQP stuff...
 AMQP_HOST = "localhost"
@@ -11,6 +18,16 @@ AMQP_IN_BROADCAST_QUEUE = "receive"
 AMQP_CONFIRM_BROADCAST_QUEUE = "confirm"
 # AMQP_OUT_BROADCAST_QUEUE = "broadcast"
 AMQP_BROADCAST_EXCHANGE = "tracks"
+# In-memory queues, used by allinone.py instead of RabbitMQ
+AMQP_MEMORY_QUEUE_SIZE = 1000
+AMQP_MEMORY_PUBLISH_TIMEOUT = None
+
+# Spotify stuff...
+SPOTIFY_LOOKUP_URL = "http://ws.spotify.com/lookup/1/.json"
+# Tracks looked up together, in one cache query
+SPOTIFY_LOOKUP_BATCH_SIZE = 10
+# Max tracks taken from albums/playlists in a single request
+SPOTIFY_EXPAND_MAX_TRACKS = 20
 
 # OAuth stuff...
 OAUTH_CONSUMER_KEY = ""
@@ -20,4 +37,33 @@ OAUTH_ACCESS_SECRET = ""
 
 # Other config options...
 NMSTEREO_SCREEN_NAME = "nmstereo"
-NMSTEREO_SEND_TWEETS = False
\ No newline at end of file
+NMSTEREO_SEND_TWEETS = False
+# DM requesters their position in the queue, and when their track should play
+NMSTEREO_SEND_ETA_DMS = False
+
+# Decoder request limits, 0 to disable...
+# Max tracks each person can request in DECODER_RATE_WINDOW seconds
+DECODER_RATE_LIMIT = 5
+DECODER_RATE_WINDOW = 600
+# Drop requests for tracks queued in the last DECODER_DUPLICATE_WINDOW seconds,
+# remembering at most DECODER_DUPLICATE_MAX tracks
+DECODER_DUPLICATE_WINDOW = 3600
+DECODER_DUPLICATE_MAX = 1000
+
+# Status API, served by the broadcaster, None to disable...
+STATUS_API_HOST = "localhost"
+STATUS_API_PORT = None
+# Played items to show in /history
+STATUS_HISTORY_SIZE = 20
+
+# Play statistics (see stats.py), months merged for top tracks and requesters
+STATS_MONTHS = 12
+
+# Logging stuff...
+LOG_LEVEL = "INFO"
+# Per-component overrides, e.g. {"receiver": "DEBUG"}
+LOG_LEVELS = {}
+# Fraction of raw payloads to dump when a component logs at DEBUG
+LOG_PAYLOAD_SAMPLE_RATE = 0.01
+# Max records buffered for the background writer, extra records are dropped
+LOG_QUEUE_SIZE = 10000
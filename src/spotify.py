@@ -5,42 +5,208 @@ Utility functions for working with the Spotify Metadata API.
 """
 
 import codecs
+import datetime
 import json
 import pprint
 import re
 import sys
 import urllib
 
-from pymongo import Connection
-
+import db
 import settings
 
 # MongoDB
-connection = Connection()
+connection = db.connection()
 store = connection[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_SPOTIFY_META_COLLECTION")]
 
 # REGEXes
 TRACK_REGEX = re.compile(r'\b(?:spotify:track:|http://open.spotify.com/track/)(\S+)\b')
+ALBUM_REGEX = re.compile(r'\b(?:spotify:album:|http://open.spotify.com/album/)(\w+)\b')
+PLAYLIST_REGEX = re.compile(r'\b(?:spotify:user:|http://open.spotify.com/user/)([^\s:/]+)[:/]playlist[:/](\w+)\b')
+
+# Where to look things up, e.g. point at a local stub (see spotify_stub.py)
+LOOKUP_URL = getattr(settings, "SPOTIFY_LOOKUP_URL", "http://ws.spotify.com/lookup/1/.json")
+
+# Fields of a track we actually use, everything else isn't cached
+TRACK_FIELDS = ("name", "artists", "length", "href", "album")
+
+# Fields only the cache needs, left out of playlist items
+CACHE_FIELDS = ("_id", "info", "cached_at")
+
+def _pick(d, fields):
+    return dict((k, d[k]) for k in fields if k in d)
+
+def _project_track(track):
+    track = _pick(track, TRACK_FIELDS)
+    if "artists" in track:
+        track["artists"] = [_pick(artist, ("name", "href")) for artist in track["artists"]]
+    if isinstance(track.get("album"), dict):
+        track["album"] = _pick(track["album"], ("name", "href"))
+    return track
+
+def project(res):
+    """
+    Returns a lookup result cut down to the fields we use, i.e. `info`, and
+    the name, artists, length, href and album of a track, or of each track in
+    an album or playlist.
+    """
+    kind = res.get("info", {}).get("type")
+    slim = _pick(res, ("_id", "info", "cached_at"))
+    if kind == "track" and "track" in res:
+        slim["track"] = _project_track(res["track"])
+    elif kind in ("album", "playlist") and kind in res:
+        slim[kind] = _pick(res[kind], ("name", "href"))
+        slim[kind]["tracks"] = [_project_track(entry) for entry in res[kind].get("tracks", [])]
+    else:
+        # Don't know what this is, leave it be
+        return res
+    return slim
+
+def playlist_track(res):
+    """
+    Returns a lookup result as kept with a playlist item, i.e. without the
+    cache's own fields, so it can be broadcast as JSON.
+    """
+    return dict((k, v) for k, v in res.iteritems() if k not in CACHE_FIELDS)
+
+def fetch(id, extras=None):
+    """
+    Looks up id with the Spotify Metadata API, and caches the result.
+    """
+    params = {"uri": id}
+    if extras:
+        params["extras"] = extras
+    try:
+        res = json.load(urllib.urlopen("%s?%s" % (LOOKUP_URL, urllib.urlencode(params))))
+        res["_id"] = id
+        res["cached_at"] = datetime.datetime.now()
+        res = project(res)
+        store.save(res)
+    except:
+        return None
+    return res
 
 def lookup(id):
     # Lookup id in MongoDB first
     res = store.find_one({"_id": id})
     if not res:
-        try:
-            res = json.load(urllib.urlopen("http://ws.spotify.com/lookup/1/.json?uri=%s" % urllib.quote(id)))
-            res["_id"] = id
-            store.save(res)
-        except:
-            return None
+        res = fetch(id)
     return res
 
+def lookup_many(ids, listed=None):
+    """
+    Looks up several ids, fetching all those already cached in a single query.
+    Those not cached but in listed (see `iter_track_uris`) are cached from
+    their listing, in a single insert.
+    
+    Returns results in the same order as ids, None for any not found.
+    """
+    ids = list(ids)
+    if not ids:
+        return []
+    found = dict((res["_id"], res) for res in store.find({"_id": {"$in": ids}}))
+    seeds = [listed[id] for id in ids if id not in found and id in (listed or {})]
+    if seeds:
+        store.insert(seeds)
+        found.update((seed["_id"], seed) for seed in seeds)
+    for id in ids:
+        if id not in found:
+            found[id] = fetch(id)
+    return [found[id] for id in ids]
+
+def iter_lookup(ids, batch_size=None, listed=None):
+    """
+    Lazily looks up ids, a batch at a time, yielding those found.
+    """
+    batch_size = batch_size or getattr(settings, "SPOTIFY_LOOKUP_BATCH_SIZE", 10)
+    batch = []
+    for id in ids:
+        batch.append(id)
+        if len(batch) >= batch_size:
+            for res in lookup_many(batch, listed):
+                if res is not None:
+                    yield res
+            batch = []
+    for res in lookup_many(batch, listed):
+        if res is not None:
+            yield res
+
 def extract_track_uris(s):
     ids = list(set(TRACK_REGEX.findall(s)))
     return ["spotify:track:" + id for id in ids]
 
+def extract_collection_uris(s):
+    """
+    Returns album and playlist URIs in s.
+    """
+    uris = ["spotify:album:" + id for id in set(ALBUM_REGEX.findall(s))]
+    uris.extend("spotify:user:%s:playlist:%s" % (user, id) for user, id in set(PLAYLIST_REGEX.findall(s)))
+    return uris
+
+def _seed_track(collection, entry):
+    """
+    Returns a track lookup result built from an album or playlist listing, or
+    None if the listing doesn't have everything we use.
+    """
+    if not all(key in entry for key in ("href", "name", "artists", "length")):
+        return None
+    track = dict(entry)
+    if "album" not in track and collection["info"]["type"] == "album":
+        track["album"] = {"name": collection["album"].get("name"), "href": collection["album"].get("href")}
+    return {"_id": entry["href"], "info": {"type": "track"}, "track": _project_track(track),
+            "cached_at": datetime.datetime.now()}
+
+def expand(uri):
+    """
+    Lazily yields the track URIs of an album or playlist, with a lookup result
+    built from each listing entry (or None), for `lookup_many` to cache.
+    """
+    collection = store.find_one({"_id": uri}) or fetch(uri, extras="track")
+    if collection is None:
+        return
+    try:
+        entries = collection[collection["info"]["type"]]["tracks"]
+    except (KeyError, TypeError):
+        return
+    for entry in entries:
+        if "href" in entry:
+            yield entry["href"], _seed_track(collection, entry)
+
+def iter_track_uris(s, limit=None, listed=None):
+    """
+    Yields track URIs in s, followed by those of any albums or playlists in s,
+    at most limit (`SPOTIFY_EXPAND_MAX_TRACKS`) of the latter.
+    
+    Listings aren't cached track by track here, but if listed is a dict, what
+    they say about each track yielded is put in it, to pass on to
+    `iter_lookup`. So only tracks that are actually looked up get cached.
+    """
+    seen = set()
+    for uri in extract_track_uris(s):
+        seen.add(uri)
+        yield uri
+    
+    if limit is None:
+        limit = getattr(settings, "SPOTIFY_EXPAND_MAX_TRACKS", 20)
+    expanded = 0
+    for collection_uri in extract_collection_uris(s):
+        # Checked before taking anything more from a listing, or looking
+        # another one up
+        if expanded >= limit:
+            return
+        for uri, seed in expand(collection_uri):
+            if uri not in seen:
+                seen.add(uri)
+                expanded += 1
+                if seed is not None and listed is not None:
+                    listed[uri] = seed
+                yield uri
+                if expanded >= limit:
+                    return
+
 def lookup_tracks(s):
-    tracks = [lookup(track) for track in extract_track_uris(s)]
-    return [track for track in tracks if track is not None]
+    listed = {}
+    return list(iter_lookup(iter_track_uris(s, listed=listed), listed=listed))
 
 if __name__ == "__main__":
     # Write UTF-8 to stdout
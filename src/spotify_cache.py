@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Maintains the Spotify metadata cache in `MONGODB_SPOTIFY_META_COLLECTION`,
+keeping it small and hot, i.e.:
+
+    $ spotify_cache.py import dump.json     # bulk import lookup results, one JSON object per line
+    $ spotify_cache.py warm -n 500          # look up the most played tracks ahead of time
+    $ spotify_cache.py compact              # cut cached entries down to the fields we use
+    $ spotify_cache.py expire --days 90     # drop entries cached more than 90 days ago
+"""
+
+import argparse
+import datetime
+import json
+
+import log
+import spotify
+import stats
+
+logger = log.get_logger("spotify_cache")
+
+def _id(res):
+    """
+    Returns the URI a lookup result is for.
+    """
+    if "_id" in res:
+        return res["_id"]
+    kind = res.get("info", {}).get("type")
+    return res.get(kind, {}).get("href")
+
+def import_dump(f, batch_size=500):
+    """
+    Imports lookup results from f, one JSON object per line, skipping any
+    already cached. Returns the number imported.
+    """
+    imported = 0
+    batch = {}
+    for line in f:
+        if not line.strip():
+            continue
+        res = json.loads(line)
+        id = _id(res)
+        if not id:
+            logger.warning("no uri, skipped", line=line[:80])
+            continue
+        res["_id"] = id
+        res["cached_at"] = datetime.datetime.now()
+        batch[id] = spotify.project(res)
+        if len(batch) >= batch_size:
+            imported += _insert(batch)
+            batch = {}
+    imported += _insert(batch)
+    return imported
+
+def _insert(batch):
+    if not batch:
+        return 0
+    # One query to find what's already there, one insert for the rest
+    for res in spotify.store.find({"_id": {"$in": batch.keys()}}, fields=["_id"]):
+        del batch[res["_id"]]
+    if batch:
+        spotify.store.insert(batch.values())
+    logger.info("imported", count=len(batch))
+    return len(batch)
+
+def warm(n=100):
+    """
+    Looks up the n most played tracks, so they're cached before anyone asks.
+    Returns the number of those now cached.
+    """
+    hrefs = [href for href, plays in stats.most_played(stats.connect(), n)]
+    return len([res for res in spotify.iter_lookup(hrefs) if res is not None])
+
+def compact():
+    """
+    Cuts every cached entry down to the fields we use, stamping entries that
+    predate `cached_at` so they eventually expire. Returns the number changed.
+    """
+    changed = 0
+    now = datetime.datetime.now()
+    for res in spotify.store.find():
+        slim = spotify.project(res)
+        slim.setdefault("cached_at", now)
+        if slim != res:
+            spotify.store.save(slim)
+            changed += 1
+    return changed
+
+def expire(days):
+    """
+    Drops entries cached more than days ago.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    spotify.store.remove({"cached_at": {"$lt": cutoff}})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the Spotify metadata cache.")
+    commands = parser.add_subparsers(dest="command")
+    p = commands.add_parser("import", help="bulk import lookup results from a dump file")
+    p.add_argument("dump", type=argparse.FileType("r"))
+    p = commands.add_parser("warm", help="look up the most played tracks")
+    p.add_argument("-n", type=int, default=100, help="how many tracks")
+    commands.add_parser("compact", help="cut entries down to the fields we use")
+    p = commands.add_parser("expire", help="drop stale entries")
+    p.add_argument("--days", type=int, default=90, help="drop entries older than this")
+    args = parser.parse_args()
+
+    # Start logging
+    log.setup()
+
+    if args.command == "import":
+        logger.info("import done", imported=import_dump(args.dump))
+    elif args.command == "warm":
+        logger.info("warm done", cached=warm(args.n))
+    elif args.command == "compact":
+        logger.info("compact done", changed=compact())
+    else:
+        expire(args.days)
+        logger.info("expire done", days=args.days)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""
+A local stub of the Spotify Metadata lookup API, for trying things out
+without hitting Spotify.
+
+Serves `GET /?uri=<uri>` from `<dir>/<uri>.json`, with colons in the URI
+replaced by underscores, e.g. `spotify_album_6G9fHYDCoyEErUkHrFYfs4.json`.
+Point `SPOTIFY_LOOKUP_URL` at it in settings, i.e.:
+
+    $ spotify_stub.py fixtures/ 8099 &
+    SPOTIFY_LOOKUP_URL = "http://localhost:8099/"
+"""
+
+import BaseHTTPServer
+import os
+import sys
+import urlparse
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    fixtures = "."
+
+    def do_GET(self):
+        params = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        uri = params.get("uri", [""])[0]
+        path = os.path.join(self.fixtures, "%s.json" % (uri.replace(":", "_"),))
+
+        if not uri or os.sep in uri or not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path) as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+if __name__ == "__main__":
+    StubHandler.fixtures = sys.argv[1] if len(sys.argv) > 1 else "."
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8099
+    server = BaseHTTPServer.HTTPServer(("localhost", port), StubHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
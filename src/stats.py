@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+Play statistics, from rollups kept up to date as tracks are played.
+
+Each play `$inc`s counters in two small documents in
+`MONGODB_STATS_COLLECTION`: one for the day it was played (`_id` e.g.
+'day:2012-06-01', with per-hour counts), and one for the month (`_id` e.g.
+'month:2012-06'). Questions are answered from a day's document, or by merging
+the last `STATS_MONTHS` months', however long the history, i.e.:
+
+    $ stats.py tracks -n 10
+    $ stats.py requesters --day 2012-06-01
+    $ stats.py hours --day 2012-06-01
+
+A rollup only grows with the plays in its day or month. Rollups can be rebuilt
+from the plays in `MONGODB_PLAYLIST_COLLECTION`, e.g. when upgrading, with the
+broadcaster stopped:
+
+    $ stats.py backfill
+"""
+
+import argparse
+import collections
+import datetime
+import heapq
+
+import db
+import settings
+
+def day_id(day):
+    return "day:%s" % (day.strftime("%Y-%m-%d"),)
+
+def month_id(month):
+    return "month:%s" % (month.strftime("%Y-%m"),)
+
+def recent_month_ids(months=None, now=None):
+    """
+    Returns the ids of the last months rollups, this month first.
+    """
+    months = months or getattr(settings, "STATS_MONTHS", 12)
+    now = now or datetime.datetime.now()
+    year, month = now.year, now.month
+    ids = []
+    for i in range(months):
+        ids.append(month_id(datetime.date(year, month, 1)))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return ids
+
+def _field(s):
+    # Field names can't contain '.' or start with '$'
+    return s.replace(".", "_").lstrip("$")
+
+def _updates(item):
+    """
+    Returns the (_id, $inc, $set) updates for a play of item.
+    """
+    track = item['track']['track']
+    played = item.get('start_date') or item['_id'].generation_time.replace(tzinfo=None)
+    track_key = _field(track['href'])
+    inc = {
+        'plays': 1,
+        'tracks.%s' % (track_key,): 1,
+    }
+    names = {'names.%s' % (track_key,): '%s / %s' % (track['artists'][0]['name'], track['name'])}
+    screen_name = (item.get('from') or {}).get('screen_name')
+    if screen_name:
+        inc['requesters.%s' % (_field(screen_name),)] = 1
+
+    day_inc = dict(inc)
+    day_inc['hours.%02d' % (played.hour,)] = 1
+    return [(month_id(played), inc, names), (day_id(played), day_inc, names)]
+
+def record_play(store, item):
+    """
+    Counts a play of item, by track, requester and hour.
+    """
+    for id, inc, names in _updates(item):
+        store.update({'_id': id}, {'$inc': inc, '$set': names}, upsert=True)
+
+def backfill(store, playlist_store):
+    """
+    Rebuilds every rollup from the played items in playlist_store, writing
+    each once, and dropping any others (e.g. the old all-time 'total').
+    Returns the number of plays counted.
+    """
+    rollups = collections.defaultdict(dict)
+    plays = 0
+    for item in playlist_store.find({'status': 'played'}):
+        try:
+            updates = _updates(item)
+        except (KeyError, IndexError, TypeError):
+            continue
+        plays += 1
+        for id, inc, names in updates:
+            rollup = rollups[id]
+            for key, n in inc.iteritems():
+                parts = key.split(".", 1)
+                if len(parts) == 1:
+                    rollup[key] = rollup.get(key, 0) + n
+                else:
+                    counts = rollup.setdefault(parts[0], {})
+                    counts[parts[1]] = counts.get(parts[1], 0) + n
+            for key, name in names.iteritems():
+                field, key = key.split(".", 1)
+                rollup.setdefault(field, {})[key] = name
+
+    store.remove()
+    for id, rollup in rollups.iteritems():
+        rollup['_id'] = id
+        store.save(rollup)
+    return plays
+
+def _rollup(store, day=None, months=None):
+    """
+    Returns day's rollup, or the last months merged.
+    """
+    if day:
+        return store.find_one({'_id': day_id(day)}) or {}
+    merged = {'tracks': collections.Counter(), 'requesters': collections.Counter(), 'names': {}}
+    for rollup in store.find({'_id': {'$in': recent_month_ids(months)}}):
+        merged['tracks'].update(rollup.get('tracks', {}))
+        merged['requesters'].update(rollup.get('requesters', {}))
+        merged['names'].update(rollup.get('names', {}))
+    return merged
+
+def most_played(store, n=10, day=None, months=None):
+    """
+    Returns the n most played tracks, recently or on day, as (href, plays).
+    """
+    return heapq.nlargest(n, _rollup(store, day, months).get('tracks', {}).iteritems(), key=lambda kv: kv[1])
+
+def top_tracks(store, n=10, day=None, months=None):
+    """
+    Returns the n most played tracks, recently or on day, as (name, plays).
+    """
+    rollup = _rollup(store, day, months)
+    names = rollup.get('names', {})
+    return [(names.get(key, key), plays)
+            for key, plays in heapq.nlargest(n, rollup.get('tracks', {}).iteritems(), key=lambda kv: kv[1])]
+
+def top_requesters(store, n=10, day=None, months=None):
+    """
+    Returns the n people with the most plays, recently or on day, as
+    (screen_name, plays).
+    """
+    rollup = _rollup(store, day, months)
+    return heapq.nlargest(n, rollup.get('requesters', {}).iteritems(), key=lambda kv: kv[1])
+
+def plays_per_hour(store, day):
+    """
+    Returns the number of plays in each hour of day, as a list of 24.
+    """
+    hours = _rollup(store, day).get('hours', {})
+    return [hours.get('%02d' % (hour,), 0) for hour in range(24)]
+
+def connect():
+    return db.connection()[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_STATS_COLLECTION", "nmstereo_stats")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show play statistics.")
+    parser.add_argument("report", choices=("tracks", "requesters", "hours", "backfill"))
+    parser.add_argument("--day", type=lambda s: datetime.datetime.strptime(s, "%Y-%m-%d"),
+                        help="YYYY-MM-DD, the last --months months if not given (today for hours)")
+    parser.add_argument("--months", type=int, help="how many months back, STATS_MONTHS if not given")
+    parser.add_argument("-n", type=int, default=10, help="how many to show")
+    args = parser.parse_args()
+
+    store = connect()
+    if args.report == "backfill":
+        playlist_store = db.connection()[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_PLAYLIST_COLLECTION")]
+        print "%d plays counted" % (backfill(store, playlist_store),)
+        rows = []
+    elif args.report == "tracks":
+        rows = top_tracks(store, args.n, args.day, args.months)
+    elif args.report == "requesters":
+        rows = top_requesters(store, args.n, args.day, args.months)
+    else:
+        rows = [("%02d:00" % (hour,), plays) for hour, plays in enumerate(plays_per_hour(store, args.day or datetime.datetime.now()))]
+
+    for label, plays in rows:
+        print (u"%6d  %s" % (plays, label)).encode("utf8")
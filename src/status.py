@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+A read-only HTTP status API, served from the broadcaster's memory.
+
+The broadcaster publishes its state whenever it changes, and each response is
+rendered to JSON once, then, so viewers cost almost nothing:
+
+    GET /now-playing, /queue, /history, /status (all three)
+        JSON, with an ETag; If-None-Match gets a 304 if nothing's changed. Add
+        ?wait=<seconds> to long-poll, i.e. hold the request until something
+        has changed.
+    GET /events
+        Server-sent events, a 'status' event (as /status) on every change.
+"""
+
+import BaseHTTPServer
+import hashlib
+import json
+import SocketServer
+import threading
+import time
+import urlparse
+
+import log
+
+logger = log.get_logger("status")
+
+PATHS = ('/now-playing', '/queue', '/history', '/status')
+
+# Longest a long-poll may wait, in seconds
+MAX_WAIT = 60
+
+# How often to send SSE keep-alives, in seconds
+KEEPALIVE = 15
+
+def summarise(item, **extra):
+    """
+    Returns the parts of a playlist item worth showing, JSON serialisable.
+    """
+    if item is None:
+        return None
+    track = item['track']['track']
+    res = {
+        'id': str(item['_id']),
+        'status': item.get('status'),
+        'track': track.get('name'),
+        'artist': track['artists'][0]['name'] if track.get('artists') else None,
+        'href': track.get('href'),
+        'length': track.get('length'),
+        'from': (item.get('from') or {}).get('screen_name'),
+    }
+    if item.get('start_date'):
+        res['start_date'] = item['start_date'].isoformat()
+    res.update(extra)
+    return res
+
+class Snapshot(object):
+    """
+    A rendered response body, and its ETag.
+    """
+    def __init__(self, data):
+        self.body = json.dumps(data)
+        self.etag = '"%s"' % (hashlib.md5(self.body).hexdigest(),)
+
+class StatusServer(object):
+    def __init__(self, host, port):
+        self.snapshots = {}
+        self.condition = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), StatusHandler)
+        self.server.status = self
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="nmstereo-status")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("listening", address="%s:%d" % self.server.server_address)
+
+    def stop(self):
+        self.server.shutdown()
+
+    def publish(self, now_playing, queue, history):
+        """
+        Renders new snapshots, and wakes any waiting clients.
+
+        now_playing is the current item (or None), queue a list of
+        (item, eta) pairs, history a list of played items, most recent first.
+        """
+        data = {
+            '/now-playing': summarise(now_playing),
+            '/queue': [summarise(item, eta=eta.isoformat()) for item, eta in queue],
+            '/history': [summarise(item) for item in history],
+        }
+        data['/status'] = {'now_playing': data['/now-playing'],
+                           'queue': data['/queue'],
+                           'history': data['/history']}
+        snapshots = dict((path, Snapshot(d)) for path, d in data.iteritems())
+
+        with self.condition:
+            self.snapshots = snapshots
+            self.condition.notify_all()
+
+    def wait(self, path, etag, timeout):
+        """
+        Returns the snapshot for path, once its ETag differs from etag, or
+        after timeout seconds.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                snapshot = self.snapshots.get(path)
+                remaining = deadline - time.time()
+                if (snapshot is not None and snapshot.etag != etag) or remaining <= 0:
+                    return snapshot
+                self.condition.wait(remaining)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        status = self.server.status
+
+        if url.path == '/events':
+            return self.events(status)
+        if url.path not in PATHS:
+            return self.send_error(404)
+
+        etag = self.headers.getheader('If-None-Match')
+        try:
+            wait = min(float(params['wait'][0]), MAX_WAIT) if 'wait' in params else 0
+        except ValueError:
+            wait = 0
+        snapshot = status.wait(url.path, etag, wait)
+
+        if snapshot is None:
+            self.send_error(503)
+        elif snapshot.etag == etag:
+            self.send_response(304)
+            self.send_header('ETag', snapshot.etag)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(snapshot.body)))
+            self.send_header('ETag', snapshot.etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(snapshot.body)
+
+    def events(self, status):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        etag = None
+        try:
+            while True:
+                snapshot = status.wait('/status', etag, KEEPALIVE)
+                if snapshot is not None and snapshot.etag != etag:
+                    etag = snapshot.etag
+                    self.wfile.write('event: status\nid: %s\ndata: %s\n\n' % (etag.strip('"'), snapshot.body))
+                else:
+                    self.wfile.write(': keep-alive\n\n')
+                self.wfile.flush()
+        except IOError:
+            # Client went away
+            pass
+
+    def log_message(self, format, *args):
+        logger.debug("request", client=self.client_address[0], request=format % args)
@@ -4,7 +4,6 @@
 Plays incoming tracks on the stereo. Tells the broadcaster when a track has been received and is playing. 
 """
 
-import codecs
 import json
 import pprint
 import subprocess
@@ -12,8 +11,11 @@ import sys
 
 import pika
 
+import log
 import settings
 
+logger = log.get_logger("stereo")
+
 class Stereo(object):
     """
     Receives tracks from the broadcaster, and plays them.
@@ -22,10 +24,13 @@ class Stereo(object):
     """
     
     timeout = False
+    in_queue_declared = False
     out_queue_declared = False
     receive_delivery_confirmations = False
     
-    def __init__(self):
+    def __init__(self, amqp=pika):
+        # AMQP, pika or an in-memory stand-in (see memory_amqp.py)
+        self.amqp = amqp
         
         # AMQP, get queue names
         self.amqp_out_queue = getattr(settings, "AMQP_CONFIRM_BROADCAST_QUEUE")
@@ -35,8 +40,8 @@ class Stereo(object):
         
         # AMQP, async style!
         # Create our connection parameters and connect to RabbitMQ
-        parameters = pika.ConnectionParameters(getattr(settings, "AMQP_HOST"))
-        self.amqp_connection = pika.SelectConnection(parameters, self.on_connected)
+        parameters = self.amqp.ConnectionParameters(getattr(settings, "AMQP_HOST"))
+        self.amqp_connection = self.amqp.SelectConnection(parameters, self.on_connected)
         
         # Add timeout handler (from http://stackoverflow.com/a/8181008)
         if self.timeout:
@@ -64,14 +69,14 @@ class Stereo(object):
         uri = track['track']['track']['href']
         
         # Play it
-        print " [x] Playing %r" % (uri,)
+        logger.info("playing", uri=uri)
         subprocess.call(('open', '-g', '/Applications/Spotify.app', uri))
         
         # Send confirmation to the broadcaster
         self.amqp_primary_channel.basic_publish(exchange='',
                                                 routing_key=self.amqp_out_queue,
                                                 body=str(track['_id']),
-                                                properties=pika.BasicProperties(
+                                                properties=self.amqp.BasicProperties(
                                                     delivery_mode=2, # make message persistent
                                                 ))
     
@@ -112,6 +117,7 @@ class Stereo(object):
         # Bind the queue to our broadcast channel
         self.amqp_primary_channel.queue_bind(exchange=self.amqp_broadcast_exchange,
                                              queue=self.amqp_in_queue)
+        self.in_queue_declared = True
         
         # Start consuming
         self.amqp_primary_channel.basic_consume(self.on_item, queue=self.amqp_in_queue)
@@ -124,7 +130,7 @@ class Stereo(object):
         Fires when we receive a new track to play.
         """
         self.track = json.loads(track)
-        print " [x] Received %r" % (self.track['track']['track']['name'],)
+        logger.info("received", track=self.track['track']['track']['name'], id=self.track['_id'])
         
         self.play(self.track)
         
@@ -139,13 +145,13 @@ class Stereo(object):
     
 
 if __name__ == "__main__":
-    # Write UTF-8 to stdout
-    sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+    # Start logging
+    log.setup()
     
     stereo = Stereo()
     
     try:
-        print ' [*] Waiting for tracks. To exit press CTRL+C'
+        logger.info("waiting for tracks", hint="To exit press CTRL+C")
         stereo.start()
     except KeyboardInterrupt:
         stereo.close()
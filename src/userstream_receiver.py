@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import codecs
 import httplib
 import ssl
 import sys
@@ -9,29 +8,33 @@ import json
 
 import tweepy
 import pika
-from pymongo import Connection
 
+import db
+import log
 import settings
 import utils
 
+logger = log.get_logger("receiver")
+
 class StreamListener(tweepy.StreamListener):
     """
     Receives the entire userstream. Forwards DMs to the Decoder.
     """
     
-    def __init__(self):
+    def __init__(self, amqp=pika):
         super(tweepy.StreamListener, self).__init__()
         
         self.screen_name = getattr(settings, "NMSTEREO_SCREEN_NAME", "nmstereo")
         
         # MongoDB
-        self.mongo_connection = Connection()
+        self.mongo_connection = db.connection()
         self.store = self.mongo_connection[getattr(settings, "MONGODB_DB_NAME")][getattr(settings, "MONGODB_USERSTREAM_COLLECTION")]
         
-        # AMQP
+        # AMQP, pika or an in-memory stand-in (see memory_amqp.py)
+        self.amqp = amqp
         self.amqp_queue = getattr(settings, "AMQP_MAIN_QUEUE")
-        self.amqp_connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=getattr(settings, "AMQP_HOST")))
+        self.amqp_connection = self.amqp.BlockingConnection(
+            self.amqp.ConnectionParameters(host=getattr(settings, "AMQP_HOST")))
         self.channel = self.amqp_connection.channel()
         self.channel.queue_declare(queue=self.amqp_queue, durable=True)
     
@@ -39,7 +42,7 @@ class StreamListener(tweepy.StreamListener):
         if not data.strip():
             return True
         
-        print " [x] Got:", data
+        logger.payload("got", data)
         
         # Decode JSON data
         item = json.loads(data)
@@ -55,11 +58,11 @@ class StreamListener(tweepy.StreamListener):
             
         # Continue processing further down the chain
         if a_direct_message or a_mention:
-            print " [x] Received", utils.get_screen_name(item), ":", utils.get_text(item)
+            logger.info("received", screen_name=utils.get_screen_name(item), text=utils.get_text(item))
             self.channel.basic_publish(exchange='',
                 routing_key=self.amqp_queue,
                 body=str(id),
-                properties=pika.BasicProperties(
+                properties=self.amqp.BasicProperties(
                     delivery_mode=2, # make message persistent
             ))
         
@@ -81,26 +84,27 @@ class StreamListener(tweepy.StreamListener):
         return True
 
 
-if __name__ == "__main__":
-    # Write UTF-8 to stdout
-    sys.stdout = codecs.getwriter('utf8')(sys.stdout)
-    
+def run(listener):
+    """
+    Connects listener to the userstream, reconnecting on errors. Exits on
+    CTRL+C, or after 5 errors.
+    """
     # Create an auth handler
     auth = tweepy.OAuthHandler(getattr(settings, "OAUTH_CONSUMER_KEY"), getattr(settings, "OAUTH_CONSUMER_SECRET"))
     auth.set_access_token(getattr(settings, "OAUTH_ACCESS_KEY"), getattr(settings, "OAUTH_ACCESS_SECRET"))
     
     # Connect to stream
-    stream = tweepy.Stream(auth, StreamListener(), secure=True)
+    stream = tweepy.Stream(auth, listener, secure=True)
     err_count = 0
     while True:
         try:
-            print ' [*] Connecting. To exit press CTRL+C'
+            logger.info("connecting", hint="To exit press CTRL+C")
             stream.userstream()
         except httplib.IncompleteRead, e:
-            print e
+            logger.error("incomplete read", error=str(e))
             err_count += 1
         except ssl.SSLError, e:
-            print e
+            logger.error("ssl error", error=str(e))
             err_count += 1
         except KeyboardInterrupt:
             stream.disconnect()
@@ -109,5 +113,12 @@ if __name__ == "__main__":
         time.sleep(5)
 
         if err_count > 4:
-            print "5 errors, quitting"
+            logger.error("5 errors, quitting")
             exit()
+
+
+if __name__ == "__main__":
+    # Start logging
+    log.setup()
+    
+    run(StreamListener())